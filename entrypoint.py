@@ -1,13 +1,22 @@
 #! /usr/bin/env python3
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+import orjson
+import hashlib
+import bisect
 import zipfile
-import shutil
-import json
+import copy
+import dbm
+import time
 import csv
+import sys
 import os
 
 DIGIKEY_API_URL_BASE = "https://api.digikey.com"
@@ -15,10 +24,84 @@ DIGIKEY_API_AUTH_ENDPOINT = DIGIKEY_API_URL_BASE + "/v1/oauth2/token"
 DIGIKEY_API_V4_KEYWORD_SEARCH_ENDPOINT = (
     DIGIKEY_API_URL_BASE + "/products/v4/search/keyword"
 )
+# Maximum number of keyword searches in flight at once. The v4 keyword search
+# only resolves exact matches for a single keyword, so parts cannot be batched
+# into one request and are instead searched for concurrently
+DIGIKEY_API_MAX_WORKERS = 16
+# On-disk cache of keyword search responses and its default expiry in seconds
+DIGIKEY_API_CACHE_PATH = "/tmp/digikey_cache"
+DIGIKEY_API_CACHE_TTL = 7 * 24 * 60 * 60
+# File the OAuth access token is cached in between runs, and the number of
+# seconds before its expiry at which a cached token is no longer reused
+DIGIKEY_API_TOKEN_CACHE_PATH = "/tmp/digikey_token.json"
+DIGIKEY_API_TOKEN_EXPIRY_MARGIN = 30
+# Directory for compiled report template bytecode reused across runs
+JINJA_BYTECODE_CACHE_PATH = "/tmp/jinja_cache"
 
 
 ################################################################################
-@dataclass
+class BackoffRetry(Retry):
+    # urllib3 retry policy that also backs off before the first retry. urllib3
+    # retries the first failure straight away and only starts waiting from the
+    # second one on, which gets a rate limited request rejected again
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if not backoff and self.history:
+            backoff = min(self.backoff_factor, self.backoff_max)
+        return backoff
+
+
+# Shared session so connections to the DigiKey API are kept alive and reused,
+# which also lets TLS sessions be resumed. All requests go to a single host, so
+# one connection pool holding a connection per worker is enough. Rate limited
+# and transient server errors are retried after waiting about 1, 2 and 4
+# seconds, or for as long as a Retry-After header asks. Both API endpoints only
+# accept POST
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=DIGIKEY_API_MAX_WORKERS,
+        max_retries=BackoffRetry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# Report files that are already compressed and are stored as-is in the
+# report archive instead of being deflated again
+PRECOMPRESSED_FILE_EXTENSIONS = {
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".woff",
+    ".woff2",
+    ".zip",
+    ".gz",
+}
+
+# ComponentData attributes populated from product parameters whose text
+# matches exactly, and from those whose text contains a substring
+EXACT_PARAM_MAP = {
+    "Package / Case": "package_case",
+    "Supplier Device Package": "supplier_device_package",
+    "Operating Temperature": "operating_temp",
+}
+SUBSTR_PARAM_MAP = (
+    ("Size", "xy_size"),
+    ("Height", "height"),
+    ("Thickness", "thickness"),
+)
+
+
+################################################################################
+@dataclass(slots=True)
 class ComponentData:
     associated_refdes: str = ""
     part_description: str = None
@@ -48,28 +131,130 @@ class ComponentData:
 
 
 ################################################################################
-def get_access_token(url, client_id, client_secret):
+class AccessTokenRejectedError(Exception):
+    # Raised when DigiKey rejects searches even after authenticating again
+    pass
+
+
+################################################################################
+def get_access_token(
+    session,
+    url,
+    client_id,
+    client_secret,
+    token_cache_path=None,
+    use_cached_token=True,
+):
+    # Return the cached access token for this client if it has not expired
+    if token_cache_path and use_cached_token:
+        try:
+            with open(token_cache_path, mode="rb") as token_cache_file:
+                cached = orjson.loads(token_cache_file.read())
+            if (
+                cached["client_id"] == client_id
+                and time.time() < cached["expires_at"] - DIGIKEY_API_TOKEN_EXPIRY_MARGIN
+            ):
+                return (200, cached["access_token"])
+        except (OSError, ValueError, KeyError):
+            pass
     # Populate request header
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
     }
     # Post the request and get the response
-    response = requests.post(
+    response = session.post(
         url,
         data={"grant_type": "client_credentials"},
         headers=headers,
         auth=(client_id, client_secret),
     )
-    # Populate the access token return value
+    # Populate the access token return value, or the server response if the
+    # authentication failed
+    token_json = orjson.loads(response.content) if response.status_code == 200 else {}
     access_token = (
-        response.json()["access_token"] if response.status_code == 200 else None
+        token_json["access_token"] if response.status_code == 200 else response.text
     )
+    # Cache the access token until it expires, readable by the owner only. The
+    # cache is best-effort, a token that cannot be cached is still returned
+    if token_cache_path and response.status_code == 200:
+        try:
+            with open(
+                os.open(token_cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                mode="wb",
+            ) as token_cache_file:
+                token_cache_file.write(
+                    orjson.dumps(
+                        {
+                            "client_id": client_id,
+                            "access_token": access_token,
+                            "expires_at": time.time() + token_json.get("expires_in", 0),
+                        }
+                    )
+                )
+        except OSError:
+            pass
     # Return response status code and access token
     return (response.status_code, access_token)
 
 
+################################################################################
+def get_search_cache_key(
+    url,
+    locale_site,
+    locale_language,
+    locale_currency,
+    customer_id,
+    keyword,
+):
+    # Key cached search results by the exact query made
+    return hashlib.sha1(
+        "|".join(
+            (
+                url,
+                locale_site,
+                locale_language,
+                locale_currency,
+                customer_id,
+                keyword,
+            )
+        ).encode()
+    ).hexdigest()
+
+
+################################################################################
+def get_cached_search_result(cache, cache_key, cache_ttl):
+    # Return the cached search result if this exact query was made recently
+    cache_entry = cache.get(cache_key)
+    if cache_entry is None:
+        return None
+    # Entries are stored as JSON rather than pickles, so a tampered cache file
+    # cannot run code. Treat unreadable entries as a miss
+    try:
+        cached = orjson.loads(cache_entry)
+    except orjson.JSONDecodeError:
+        cached = None
+    if cached is not None and time.time() - cached["timestamp"] < cache_ttl:
+        return cached["body"]
+    # Drop the expired or unreadable entry so that the cache does not grow
+    # without bound
+    del cache[cache_key]
+    return None
+
+
+################################################################################
+def cache_search_result(cache, cache_key, keyword_search_json):
+    # Cache a successful search result for subsequent runs
+    cache[cache_key] = orjson.dumps(
+        {
+            "timestamp": time.time(),
+            "body": keyword_search_json,
+        }
+    )
+
+
 ################################################################################
 def query_digikey_v4_API_keyword_search(
+    session,
     url,
     client_id,
     access_token,
@@ -95,15 +280,15 @@ def query_digikey_v4_API_keyword_search(
     request_data = {
         "Keywords": keyword,
     }
-    # Post the request and get the response
-    response = requests.post(
+    # Post the request as a JSON body and get the response
+    response = session.post(
         url,
-        data=str(json.dumps(request_data)),
+        data=orjson.dumps(request_data),
         headers=headers,
     )
     # Populate the search result return value
     keyword_search_json = (
-        response.json() if response.status_code == 200 else response.text
+        orjson.loads(response.content) if response.status_code == 200 else response.text
     )
     # Return response status code and search result
     return (response.status_code, keyword_search_json)
@@ -142,48 +327,56 @@ def extract_data_from_digikey_search_response(keyword_search_json):
         # Get the pricing information
         part_data.pricing = product_data["ProductVariations"]
         # Remove Digi-Reel and rename as DR/CT if both Digi-Reel and Cut-Tape exist
-        pricing_variations = [
-            variation["PackageType"]["Name"] for variation in part_data.pricing
-        ]
-        cut_tape_idx = digi_reel_idx = [
-            i
-            for i in range(0, len(pricing_variations))
-            if "Cut Tape" in pricing_variations[i]
-        ]
-        digi_reel_idx = [
-            i
-            for i in range(0, len(pricing_variations))
-            if "Digi-Reel" in pricing_variations[i]
-        ]
-        if cut_tape_idx and digi_reel_idx:
-            part_data.pricing[cut_tape_idx[0]]["PackageType"]["Name"] = (
+        cut_tape_idx = digi_reel_idx = None
+        for idx, variation in enumerate(part_data.pricing):
+            package_type_name = variation["PackageType"]["Name"]
+            if cut_tape_idx is None and "Cut Tape" in package_type_name:
+                cut_tape_idx = idx
+            elif digi_reel_idx is None and "Digi-Reel" in package_type_name:
+                digi_reel_idx = idx
+            if cut_tape_idx is not None and digi_reel_idx is not None:
+                break
+        if cut_tape_idx is not None and digi_reel_idx is not None:
+            part_data.pricing[cut_tape_idx]["PackageType"]["Name"] = (
                 "Cut Tape (CT) & Digi-Reel®"
             )
-            del part_data.pricing[digi_reel_idx[0]]
+            del part_data.pricing[digi_reel_idx]
         # Initialize part parameter variables
         part_data.package_case = part_data.supplier_device_package = (
             part_data.operating_temp
         ) = part_data.xy_size = part_data.height = part_data.thickness = None
-        # Get product parameter information
-        for parameter in product_data["Parameters"]:
-            if "ParameterText" in parameter.keys():
-                # Get the package / case
-                if parameter["ParameterText"] == "Package / Case":
-                    part_data.package_case = parameter["ValueText"]
-                # Get the supplier device package
-                if parameter["ParameterText"] == "Supplier Device Package":
-                    part_data.supplier_device_package = parameter["ValueText"]
-                # Get the operating temperature range
-                if parameter["ParameterText"] == "Operating Temperature":
-                    part_data.operating_temp = parameter["ValueText"]
-                # Get the package XY dimensions
-                if "Size" in parameter["ParameterText"]:
-                    part_data.xy_size = parameter["ValueText"]
-                # Get the package height or thickness
-                if "Height" in parameter["ParameterText"]:
-                    part_data.height = parameter["ValueText"]
-                if "Thickness" in parameter["ParameterText"]:
-                    part_data.thickness = parameter["ValueText"]
+        # Get product parameter information. Later parameters take precedence,
+        # so walk them from last to first, keeping the first value found for
+        # each attribute and stopping as soon as every attribute has been found
+        num_param_attrs = len(EXACT_PARAM_MAP) + len(SUBSTR_PARAM_MAP)
+        found_param_attrs = set()
+        for parameter in reversed(product_data["Parameters"]):
+            parameter_text = parameter.get("ParameterText")
+            if not parameter_text:
+                continue
+            # Get the package / case, supplier device package and operating
+            # temperature range
+            attr = EXACT_PARAM_MAP.get(parameter_text)
+            if attr:
+                if attr not in found_param_attrs:
+                    value_text = parameter["ValueText"]
+                    setattr(part_data, attr, value_text)
+                    found_param_attrs.add(attr)
+            # Get the package XY dimensions, height or thickness, reading the
+            # value once however many of them the parameter text matches
+            else:
+                substr_attrs = [
+                    substr_attr
+                    for substr, substr_attr in SUBSTR_PARAM_MAP
+                    if substr in parameter_text and substr_attr not in found_param_attrs
+                ]
+                if substr_attrs:
+                    value_text = parameter["ValueText"]
+                    for substr_attr in substr_attrs:
+                        setattr(part_data, substr_attr, value_text)
+                    found_param_attrs.update(substr_attrs)
+            if len(found_param_attrs) == num_param_attrs:
+                break
         # Get environmental and classification data
         try:
             part_data.rohs_status = product_data["Classifications"]["RohsStatus"]
@@ -195,15 +388,14 @@ def extract_data_from_digikey_search_response(keyword_search_json):
             part_data.htsus = product_data["Classifications"]["HtsusCode"]
         except KeyError:
             pass
-        # Get the category chain
-        part_data.categories.append(product_data["Category"]["Name"])
+        # Get the category chain by descending through the first child category
+        categories = part_data.categories
+        categories.append(product_data["Category"]["Name"])
         child_categories = product_data["Category"]["ChildCategories"]
-        while True:
-            if child_categories:
-                part_data.categories.append(child_categories[0]["Name"])
-                child_categories = child_categories[0]["ChildCategories"]
-            else:
-                break
+        while child_categories:
+            child_category = child_categories[0]
+            categories.append(child_category["Name"])
+            child_categories = child_category["ChildCategories"]
 
     # Return the extracted part data
     return part_data
@@ -224,7 +416,10 @@ def get_prices_for_target_qtys(part_data, single_pcb_part_qty, pcb_quantities):
                 pricing_for_price_type = {}
                 pricing_for_price_type["package_type"] = pricing_type["PackageType"]
                 pricing_for_price_type["cogs"] = []
-                # Get price breakpoints for this pricing type
+                # Get price breakpoints for this pricing type in ascending order
+                std_pricing = sorted(
+                    std_pricing, key=lambda stdpricing: int(stdpricing["BreakQuantity"])
+                )
                 breakpoints = [
                     int(stdpricing["BreakQuantity"]) for stdpricing in std_pricing
                 ]
@@ -237,39 +432,17 @@ def get_prices_for_target_qtys(part_data, single_pcb_part_qty, pcb_quantities):
                         "pcb_qty": pcb_qty,
                         "total_part_qty": part_qty,
                     }
-                    # Set the breakpoint index to start or end of list, or as None,
-                    # depending on the quantity. Set pricing for edge case
-                    breakpoint_idx = (
-                        0
-                        if part_qty <= min(breakpoints)
-                        else -1
-                        if part_qty >= max(breakpoints)
-                        else None
+                    # Find the highest breakpoint at or below the quantity, using
+                    # the lowest breakpoint for quantities below all of them
+                    breakpoint = std_pricing[
+                        max(bisect.bisect_right(breakpoints, part_qty) - 1, 0)
+                    ]
+                    # Populate break quantity and prices for the target quantity
+                    pricing_for_pcb_qty["break_qty"] = breakpoint["BreakQuantity"]
+                    pricing_for_pcb_qty["price_per_unit"] = breakpoint["UnitPrice"]
+                    pricing_for_pcb_qty["total_price"] = (
+                        breakpoint["UnitPrice"] * part_qty
                     )
-                    if breakpoint_idx is not None:
-                        pricing_for_pcb_qty["break_qty"] = std_pricing[breakpoint_idx][
-                            "BreakQuantity"
-                        ]
-                        pricing_for_pcb_qty["price_per_unit"] = std_pricing[
-                            breakpoint_idx
-                        ]["UnitPrice"]
-                        pricing_for_pcb_qty["total_price"] = (
-                            std_pricing[breakpoint_idx]["UnitPrice"] * part_qty
-                        )
-                    else:
-                        # Populate break quantity and prices the target quantity
-                        for breakpoint in std_pricing:
-                            # If breakpoint index already set, populate
-                            if part_qty >= breakpoint["BreakQuantity"]:
-                                pricing_for_pcb_qty["break_qty"] = breakpoint[
-                                    "BreakQuantity"
-                                ]
-                                pricing_for_pcb_qty["price_per_unit"] = breakpoint[
-                                    "UnitPrice"
-                                ]
-                                pricing_for_pcb_qty["total_price"] = (
-                                    breakpoint["UnitPrice"] * part_qty
-                                )
                     # Append the pricing for this PCB quantity to the list
                     pricing_for_price_type["cogs"].append(pricing_for_pcb_qty)
                 # Add pricing dict to the list of pricing types
@@ -278,6 +451,128 @@ def get_prices_for_target_qtys(part_data, single_pcb_part_qty, pcb_quantities):
     return pcb_qty_prices_by_part_type
 
 
+################################################################################
+def get_digikey_search_results(
+    submit_search,
+    cache_key_by_mpn,
+    access_token,
+    reauthenticate,
+    cache,
+    cache_ttl,
+):
+    # Reuse the cached search results from previous runs where possible, and
+    # search for the remaining parts concurrently, tracking the part number and
+    # the access token of each search. The cache is only accessed from this
+    # thread, dbm databases such as dbm.sqlite3 cannot be shared between
+    # threads
+    cached_search_results = []
+    futures = {}
+    for mpn, cache_key in cache_key_by_mpn.items():
+        keyword_search_json = get_cached_search_result(cache, cache_key, cache_ttl)
+        if keyword_search_json is not None:
+            cached_search_results.append((mpn, 200, keyword_search_json))
+        else:
+            future = submit_search(access_token=access_token, keyword=mpn)
+            futures[future] = (mpn, access_token)
+    yield from cached_search_results
+    reauthenticated = False
+    # Yield the part number, response status code and search result of each
+    # search as it completes
+    pending = set(futures)
+    while pending:
+        (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            (mpn, search_access_token) = futures.pop(future)
+            (response_code, keyword_search_json) = future.result()
+            if response_code == 401:
+                # The first time the current access token is rejected,
+                # authenticate again without the cached token
+                if search_access_token == access_token and not reauthenticated:
+                    reauthenticated = True
+                    print("- Access token rejected, authenticating again")
+                    (auth_response_code, new_access_token) = reauthenticate()
+                    if auth_response_code == 200:
+                        access_token = new_access_token
+                    else:
+                        print("Authentication failed. Response from server:")
+                        print(new_access_token)
+                # Give up if the search was rejected with the current access
+                # token, otherwise retry it with the new one
+                if search_access_token == access_token:
+                    raise AccessTokenRejectedError(keyword_search_json)
+                retry_future = submit_search(access_token=access_token, keyword=mpn)
+                futures[retry_future] = (mpn, access_token)
+                pending.add(retry_future)
+                continue
+            # Cache successful search results for subsequent runs
+            if response_code == 200:
+                cache_search_result(cache, cache_key_by_mpn[mpn], keyword_search_json)
+            yield (mpn, response_code, keyword_search_json)
+
+
+################################################################################
+class BomItemsDigikeyData:
+    # Part data of the BOM line items, fanned out from the search results as
+    # they arrive. Iterating yields the part data in BOM order regardless of
+    # which search finishes first, and records it in part_data
+    def __init__(
+        self, search_results, line_item_idxs_by_mpn, bom_line_items, pcb_quantities
+    ):
+        self.search_results = search_results
+        self.line_item_idxs_by_mpn = line_item_idxs_by_mpn
+        self.bom_line_items = bom_line_items
+        self.pcb_quantities = pcb_quantities
+        self.part_data = []
+
+    def __iter__(self):
+        # Initialize one part data slot per line item and track which line items
+        # have been processed
+        part_data_by_idx = [None] * len(self.bom_line_items)
+        processed = [False] * len(self.bom_line_items)
+        next_idx = 0
+        # Process the responses as they arrive
+        for mpn, response_code, keyword_search_json in self.search_results:
+            print("- Fetching info for " + mpn + "... ✔", flush=True)
+            # Process a successful response
+            if response_code == 200:
+                # Extract the part data from the keyword search response
+                mpn_part_data = extract_data_from_digikey_search_response(
+                    keyword_search_json
+                )
+            # Print out the details of an unsuccessful response
+            else:
+                print("DigiKey API search unsuccesful:")
+                print(response_code, keyword_search_json)
+                mpn_part_data = None
+            # Fan the part data out to every line item with this part number
+            for idx in self.line_item_idxs_by_mpn[mpn]:
+                processed[idx] = True
+                if mpn_part_data is None:
+                    continue
+                part_data = copy.copy(mpn_part_data)
+                # Add the associated reference designators
+                (_, part_data.associated_refdes) = self.bom_line_items[idx]
+                # Get the COGS pricing if PCB quantities specified
+                if self.pcb_quantities:
+                    # Get the number of components needed for this part
+                    part_qty = len(part_data.associated_refdes.split(","))
+                    # Iterate PCB quantities and get prices for component
+                    # quantities at each PCB quantity. Add COGS breakdown to
+                    # the component data set
+                    part_data.cogs_breakdown = get_prices_for_target_qtys(
+                        part_data, part_qty, self.pcb_quantities
+                    )
+                part_data_by_idx[idx] = part_data
+            # Yield the part data of the line items that are next in BOM order
+            # and record it
+            while next_idx < len(self.bom_line_items) and processed[next_idx]:
+                part_data = part_data_by_idx[next_idx]
+                if part_data is not None:
+                    self.part_data.append(part_data)
+                    yield part_data
+                next_idx += 1
+
+
 ################################################################################
 if __name__ == "__main__":
     # Initialize argument parser
@@ -306,18 +601,55 @@ if __name__ == "__main__":
         const="html",
         nargs="?",
     )
+    parser.add_argument(
+        "--cache_path",
+        help=(
+            "File path prefix of the on-disk cache of DigiKey search results. "
+            + "Defaults to '%(default)s'."
+        ),
+        default=DIGIKEY_API_CACHE_PATH,
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=int,
+        help=(
+            "Number of seconds a cached DigiKey search result stays valid. "
+            + "Defaults to %(default)s (one week)."
+        ),
+        default=DIGIKEY_API_CACHE_TTL,
+    )
     args = parser.parse_args()
 
+    # Authenticate with DigiKey
+    digikey_client_id = os.environ.get("DIGIKEY_CLIENT_ID")
+    digikey_client_secret = os.environ.get("DIGIKEY_CLIENT_SECRET")
+    (response_code, access_token) = get_access_token(
+        SESSION,
+        DIGIKEY_API_AUTH_ENDPOINT,
+        digikey_client_id,
+        digikey_client_secret,
+        DIGIKEY_API_TOKEN_CACHE_PATH,
+    )
+
+    # Cannot proceed with search API queries if authentication failed,
+    # exit before reading the BOM.
+    if response_code != 200:
+        print("Authentication failed. Response from server:")
+        print(access_token)
+        print("Exiting...")
+        sys.exit(1)
+
     # Read the BOM file into list
-    with open(args.bom_file, newline="") as bomfile:
+    with open(
+        args.bom_file, newline="", encoding="utf-8-sig", buffering=1 << 20
+    ) as bomfile:
         # Comma delimited file with " as quote character to be included
         bomreader = csv.reader(bomfile, delimiter=",", quotechar='"')
-        # Save as a list
-        bom_line_items = list(bomreader)
-        # Save the index of the designator field
-        refdes_col_idx = (bom_line_items[0]).index("Designator")
-        # Skip the header
-        del bom_line_items[0]
+        # Consume the header and save the index of the designator field
+        refdes_col_idx = next(bomreader).index("Designator")
+        # Save the Manufacturer Part Number and reference designators of the
+        # remaining line items as a list
+        bom_line_items = [(row[0], row[refdes_col_idx]) for row in bomreader]
 
     # Get the PCB quantities, if specified
     pcb_quantities = []
@@ -330,93 +662,154 @@ if __name__ == "__main__":
         except Exception:
             pass
 
-    # Authenticate with DigiKey
-    digikey_client_id = os.environ.get("DIGIKEY_CLIENT_ID")
-    digikey_client_secret = os.environ.get("DIGIKEY_CLIENT_SECRET")
-    (response_code, access_token) = get_access_token(
-        DIGIKEY_API_AUTH_ENDPOINT, digikey_client_id, digikey_client_secret
-    )
+    # Group the line items by Manufacturer Part Number so that each distinct
+    # part is only searched for once
+    line_item_idxs_by_mpn = {}
+    for idx, (mpn, _) in enumerate(bom_line_items):
+        line_item_idxs_by_mpn.setdefault(mpn, []).append(idx)
 
-    # Cannot proceed with search API queries if authentication failed,
-    # exit gracefully.
-    if response_code != 200:
-        print("Authentication failed. Response from server:")
-        print(access_token)
-        print("Exiting...")
-
-    # Initialize list of BOM item part data
-    bom_items_digikey_data = []
-
-    # Fetch information for all parts in the BOM
-    for line_item in bom_line_items:
-        print("- Fetching info for " + line_item[0] + "... ", end="")
-        # Search for parts in DigiKey by Manufacturer Part Number as keyword
-        (response_code, keyword_search_json) = query_digikey_v4_API_keyword_search(
-            DIGIKEY_API_V4_KEYWORD_SEARCH_ENDPOINT,
-            digikey_client_id,
-            access_token,
-            "US",
-            "en",
-            "USD",
-            "0",
-            line_item[0],
-        )
-        print("✔" + "\n", end="", flush=True)
-        # Process a successful response
-        if response_code == 200:
-            # Extract the part data from the keyword search response
-            part_data = extract_data_from_digikey_search_response(keyword_search_json)
-            # Add the associated reference designators
-            part_data.associated_refdes = line_item[refdes_col_idx]
-            # Get the COGS pricing if PCB quantities specified
-            if args.pcb_quantities:
-                # Get the number of components needed for this part
-                part_qty = len(part_data.associated_refdes.split(","))
-                # Initialize a COGS breakdown dict for the different quantities
-                cogs_breakdown = {}
-                # Iterate PCB quantities and get prices for component quantities
-                # at each PCB quantity. Add COGS breakdown to the component data set
-                part_data.cogs_breakdown = get_prices_for_target_qtys(
-                    part_data, part_qty, pcb_quantities
-                )
-            # Add the extracted data to the list of BOM items part data
-            bom_items_digikey_data.append(part_data)
-        # Print out the details of an unsuccessful response
-        else:
-            print("DigiKey API search unsuccesful:")
-            print(response_code, keyword_search_json)
-
-    # Load Jinja with output HTML template
-    template_env = Environment(loader=FileSystemLoader("/report_template/"))
+    # Load Jinja with output HTML template, reusing the compiled template from
+    # previous runs if available
+    try:
+        os.makedirs(JINJA_BYTECODE_CACHE_PATH)
+    except FileExistsError:
+        pass
+    template_env = Environment(
+        loader=FileSystemLoader("/report_template/"),
+        bytecode_cache=FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_PATH),
+        auto_reload=False,
+    )
     template = template_env.get_template("index.html")
-    # Populuate the context data
-    context = {"bom": bom_items_digikey_data}
     # Create report output folder if it doesn't exist
     try:
         os.makedirs("/component_report")
     except FileExistsError:
         pass
-    # Unzip the JS/CSS assets
-    shutil.unpack_archive("/report_template/assets.zip", "/component_report")
-    # Write HTML output file
-    with open(
-        "/component_report/index.html", mode="w", encoding="utf-8"
-    ) as report_file:
-        print("- Outputting report")
-        report_file.write(template.render(context))
-    # Zip the component report as a git workspace artifact
-    with zipfile.ZipFile(
-        args.output_path + "/component_report.zip", "w", zipfile.ZIP_DEFLATED
-    ) as zipper:
-        for root, dirs, files in os.walk("/component_report"):
-            for file in files:
-                zipper.write(os.path.join(root, file))
-    # Convert all ComponentData objects in the BOM items DigiKey data
-    # list to dictionaries in preparation for JSON output
-    for idx in range(0, len(bom_items_digikey_data)):
-        bom_items_digikey_data[idx] = bom_items_digikey_data[idx].__dict__
-    # Output the BOM items DigiKey data as a json file
+    # Create the search cache folder if it doesn't exist
+    if os.path.dirname(args.cache_path):
+        try:
+            os.makedirs(os.path.dirname(args.cache_path))
+        except FileExistsError:
+            pass
+
+    # Fetch information for all parts in the BOM concurrently, reusing cached
+    # search results from previous runs where possible. The HTML output file
+    # is rendered while the searches are in flight, streaming each part to
+    # the file as soon as it and the parts before it in the BOM are fetched.
+    # A 1 MiB write buffer keeps the number of write syscalls low for large
+    # reports
+    with (
+        dbm.open(args.cache_path, "c") as cache,
+        ThreadPoolExecutor(max_workers=DIGIKEY_API_MAX_WORKERS) as executor,
+        open(
+            "/component_report/index.html",
+            mode="w",
+            encoding="utf-8",
+            buffering=1 << 20,
+        ) as report_file,
+    ):
+        # Search for parts in DigiKey by Manufacturer Part Number as keyword
+        search_locale = {
+            "locale_site": "US",
+            "locale_language": "en",
+            "locale_currency": "USD",
+            "customer_id": "0",
+        }
+        submit_search = partial(
+            executor.submit,
+            query_digikey_v4_API_keyword_search,
+            SESSION,
+            DIGIKEY_API_V4_KEYWORD_SEARCH_ENDPOINT,
+            digikey_client_id,
+            **search_locale,
+        )
+        cache_key_by_mpn = {
+            mpn: get_search_cache_key(
+                DIGIKEY_API_V4_KEYWORD_SEARCH_ENDPOINT, keyword=mpn, **search_locale
+            )
+            for mpn in line_item_idxs_by_mpn
+        }
+        # Populate the context data with the part data of the BOM line items,
+        # authenticating again without the cached token if DigiKey rejects it
+        bom_items_digikey_data = BomItemsDigikeyData(
+            get_digikey_search_results(
+                submit_search,
+                cache_key_by_mpn,
+                access_token,
+                partial(
+                    get_access_token,
+                    SESSION,
+                    DIGIKEY_API_AUTH_ENDPOINT,
+                    digikey_client_id,
+                    digikey_client_secret,
+                    DIGIKEY_API_TOKEN_CACHE_PATH,
+                    use_cached_token=False,
+                ),
+                cache,
+                args.cache_ttl,
+            ),
+            line_item_idxs_by_mpn,
+            bom_line_items,
+            pcb_quantities if args.pcb_quantities else None,
+        )
+        context = {"bom": bom_items_digikey_data}
+        # Write HTML output file. Cannot publish the report if searches were
+        # still rejected after authenticating again. Discard the cached access
+        # token so that the next run authenticates from scratch, and exit
+        # without publishing the report
+        template_stream = template.stream(context)
+        template_stream.enable_buffering(size=64)
+        try:
+            template_stream.dump(report_file)
+        except AccessTokenRejectedError:
+            try:
+                os.remove(DIGIKEY_API_TOKEN_CACHE_PATH)
+            except FileNotFoundError:
+                pass
+            print("DigiKey API rejected the access token. Exiting...")
+            sys.exit(1)
+
+    # Output the report archive and the BOM items DigiKey data
+    print("- Outputting report")
+    # Zip the component report as a git workspace artifact. The JS/CSS assets
+    # are copied straight from the template's assets archive rather than
+    # being unpacked to disk first. Text files are deflated at a low level for
+    # speed, already compressed files are stored
+    with (
+        zipfile.ZipFile("/report_template/assets.zip") as assets_zip,
+        zipfile.ZipFile(
+            args.output_path + "/component_report.zip",
+            "w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=1,
+        ) as zipper,
+    ):
+        for asset_info in assets_zip.infolist():
+            if asset_info.is_dir():
+                continue
+            compress_type = (
+                zipfile.ZIP_STORED
+                if os.path.splitext(asset_info.filename)[1].lower()
+                in PRECOMPRESSED_FILE_EXTENSIONS
+                else zipfile.ZIP_DEFLATED
+            )
+            # Copy the entry metadata, including its timestamp and permissions,
+            # under the report folder
+            report_asset_info = copy.copy(asset_info)
+            report_asset_info.filename = "component_report/" + asset_info.filename
+            zipper.writestr(
+                report_asset_info,
+                assets_zip.read(asset_info),
+                compress_type=compress_type,
+                compresslevel=zipper.compresslevel,
+            )
+        zipper.write("/component_report/index.html", "component_report/index.html")
+    # Output the BOM items DigiKey data as a json file, letting orjson encode
+    # the ComponentData objects directly and writing the encoded bytes rather
+    # than decoding them to a string first
     with open(
-        "digikey_data_from_bom.json", mode="w", encoding="utf-8"
+        "digikey_data_from_bom.json", mode="wb", buffering=1 << 20
     ) as json_output_file:
-        json_output_file.write(json.dumps(bom_items_digikey_data, indent=2))
+        json_output_file.write(
+            orjson.dumps(bom_items_digikey_data.part_data, option=orjson.OPT_INDENT_2)
+        )